@@ -0,0 +1,62 @@
+"""integer customer_id and BRIN date index
+
+Revision ID: integer_customer_id
+Revises: initial
+Create Date: 2026-10-15 10:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "integer_customer_id"
+down_revision = "initial"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.drop_index(
+        op.f("ix_customerdailystats_customer_id_date"), table_name="customerdailystats"
+    )
+    op.alter_column(
+        "customerdailystats",
+        "customer_id",
+        existing_type=sa.String(),
+        type_=sa.Integer(),
+        existing_nullable=False,
+        postgresql_using="substring(customer_id from '[0-9]+$')::integer",
+    )
+    op.create_unique_constraint(
+        "uq_customerdailystats_customer_id_date",
+        "customerdailystats",
+        ["customer_id", "date"],
+    )
+    op.create_index(
+        "ix_customerdailystats_date_brin",
+        "customerdailystats",
+        ["date"],
+        postgresql_using="brin",
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_customerdailystats_date_brin", table_name="customerdailystats")
+    op.drop_constraint(
+        "uq_customerdailystats_customer_id_date", "customerdailystats", type_="unique"
+    )
+    op.alter_column(
+        "customerdailystats",
+        "customer_id",
+        existing_type=sa.Integer(),
+        type_=sa.String(),
+        existing_nullable=False,
+        postgresql_using="'cust_' || customer_id",
+    )
+    op.create_index(
+        op.f("ix_customerdailystats_customer_id_date"),
+        "customerdailystats",
+        ["customer_id", "date"],
+        unique=True,
+    )
@@ -0,0 +1,54 @@
+"""latency digests and weekly rollup view
+
+Revision ID: weekly_stats
+Revises: integer_customer_id
+Create Date: 2026-10-15 12:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "weekly_stats"
+down_revision = "integer_customer_id"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "customerdailystats",
+        sa.Column("latency_digest", sa.LargeBinary(), nullable=True),
+    )
+    # Serialized digests are packed centroid arrays, so concatenating the
+    # daily digests of a week yields that week's digest.
+    op.execute(
+        """
+        CREATE MATERIALIZED VIEW customer_weekly_stats AS
+        SELECT
+            customer_id,
+            date_trunc('week', date)::date AS week,
+            sum(successful_requests) AS successful_requests,
+            sum(failed_requests) AS failed_requests,
+            avg(uptime_percentage) AS uptime_percentage,
+            sum(avg_latency * (successful_requests + failed_requests))
+                / nullif(sum(successful_requests + failed_requests), 0)
+                AS avg_latency,
+            string_agg(latency_digest, ''::bytea ORDER BY date) AS latency_digest
+        FROM customerdailystats
+        GROUP BY customer_id, date_trunc('week', date)
+        """
+    )
+    # Required by REFRESH MATERIALIZED VIEW CONCURRENTLY
+    op.create_index(
+        "ix_customer_weekly_stats_customer_id_week",
+        "customer_weekly_stats",
+        ["customer_id", "week"],
+        unique=True,
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP MATERIALIZED VIEW customer_weekly_stats")
+    op.drop_column("customerdailystats", "latency_digest")
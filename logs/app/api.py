@@ -1,27 +1,113 @@
+from itertools import chain
+from typing import Callable, Iterable, Iterator, List, Literal
+
+import orjson
 from fastapi import FastAPI, HTTPException, Query
-from sqlalchemy.orm import Session
-from datetime import date
-from app.models import CustomerDailyStats, engine
-from sqlalchemy import select
+from fastapi.responses import StreamingResponse
+from datetime import date, timedelta
+from app.models import (
+    CustomerDailyStats,
+    customer_id_to_int,
+    customer_id_to_str,
+    customer_weekly_stats,
+    deserialize_digest,
+    engine,
+)
+from sqlalchemy import Connection, RowMapping, select
+
+STREAM_BATCH_SIZE = 500
 
 app = FastAPI()
 
 
+def daily_row_to_dict(row: RowMapping) -> dict:
+    """Convert a daily stats row, restoring the external customer id"""
+    stats = dict(row)
+    stats["customer_id"] = customer_id_to_str(stats["customer_id"])
+    return stats
+
+
+def weekly_row_to_dict(row: RowMapping) -> dict:
+    """Convert a weekly rollup row, estimating quantiles from its merged digest"""
+    stats = daily_row_to_dict(row)
+    digest = deserialize_digest(stats.pop("latency_digest"))
+    has_latencies = digest.size() > 0
+    stats["median_latency"] = float(digest.quantile(0.5)) if has_latencies else None
+    stats["p99_latency"] = float(digest.quantile(0.99)) if has_latencies else None
+    return stats
+
+
+def iter_json(
+    connection: Connection,
+    batches: Iterable[List[RowMapping]],
+    to_dict: Callable[[RowMapping], dict] = dict,
+) -> Iterator[bytes]:
+    """Serialize row batches into one JSON array, then close the connection"""
+    try:
+        separator = b"["
+        for batch in batches:
+            # One orjson call per batch; strip its brackets to splice batches.
+            # Reflected column names are str subclasses, which orjson only
+            # accepts as keys with OPT_NON_STR_KEYS.
+            chunk = orjson.dumps(
+                [to_dict(row) for row in batch], option=orjson.OPT_NON_STR_KEYS
+            )
+            yield separator + chunk[1:-1]
+            separator = b","
+        yield b"[]" if separator == b"[" else b"]"
+    finally:
+        connection.close()
+
+
 @app.get("/customers/{customer_id}/stats")
 def get_customer_stats(
-    customer_id: str, from_: date | None = Query(None, alias="from")
+    customer_id: str,
+    from_: date | None = Query(None, alias="from"),
+    granularity: Literal["day", "week"] = "day",
 ):
-    with Session(engine) as session:
-        query = select(CustomerDailyStats).where(
-            CustomerDailyStats.customer_id == customer_id
-        )
+    try:
+        customer_key = customer_id_to_int(customer_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="No stats found for customer")
 
+    if granularity == "week":
+        # Served from the customer_weekly_stats materialized view
+        query = select(customer_weekly_stats).where(
+            customer_weekly_stats.c.customer_id == customer_key
+        )
+        if from_:
+            week_start = from_ - timedelta(days=from_.weekday())
+            query = query.where(customer_weekly_stats.c.week >= week_start)
+        to_dict = weekly_row_to_dict
+    else:
+        columns = [
+            column
+            for column in CustomerDailyStats.__table__.columns
+            if column.name != "latency_digest"
+        ]
+        query = select(*columns).where(CustomerDailyStats.customer_id == customer_key)
         if from_:
             query = query.where(CustomerDailyStats.date >= from_)
+        to_dict = daily_row_to_dict
 
-        results = session.execute(query).scalars().all()
+    # Stream row mappings from a server-side cursor instead of loading them all
+    connection = engine.connect()
+    try:
+        results = (
+            connection.execution_options(yield_per=STREAM_BATCH_SIZE)
+            .execute(query)
+            .mappings()
+        )
+        first_batch = results.fetchmany(STREAM_BATCH_SIZE)
+    except Exception:
+        connection.close()
+        raise
 
-        if not results:
-            raise HTTPException(status_code=404, detail="No stats found for customer")
+    if not first_batch:
+        connection.close()
+        raise HTTPException(status_code=404, detail="No stats found for customer")
 
-        return results
+    return StreamingResponse(
+        iter_json(connection, chain([first_batch], results.partitions()), to_dict),
+        media_type="application/json",
+    )
@@ -1,5 +1,6 @@
 import os
 import psycopg2
+from psycopg2 import errors, sql
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
 # Default database connection settings
@@ -30,9 +31,18 @@ def create_database_and_schema():
     db_name = os.getenv("POSTGRES_DB", DEFAULT_DB_NAME)
 
     # Create database if it doesn't exist
-    cursor.execute(f"SELECT 1 FROM pg_catalog.pg_database WHERE datname = '{db_name}'")
+    cursor.execute(
+        "SELECT 1 FROM pg_catalog.pg_database WHERE datname = %s", (db_name,)
+    )
     if not cursor.fetchone():
-        cursor.execute(f"CREATE DATABASE {db_name}")
+        # CREATE DATABASE cannot take a bind parameter, so quote the identifier
+        try:
+            cursor.execute(
+                sql.SQL("CREATE DATABASE {}").format(sql.Identifier(db_name))
+            )
+        except errors.DuplicateDatabase:
+            # Another process created it between the check and the CREATE
+            pass
 
     cursor.close()
     conn.close()
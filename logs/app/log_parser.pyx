@@ -0,0 +1,128 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""C implementation of log_processor's log line parser.
+
+Build in place with `python setup.py build_ext --inplace`; log_processor
+falls back to its pure-Python parser when this module is not compiled.
+"""
+
+from datetime import timezone
+
+from cpython.datetime cimport datetime_new, import_datetime
+from libc.stdlib cimport strtod, strtol
+
+import_datetime()
+
+cdef object UTC = timezone.utc
+# Bounds of the Postgres `integer` customer_id column, as in models
+cdef long CUSTOMER_ID_MIN = -2147483648
+cdef long CUSTOMER_ID_MAX = 2147483647
+cdef int[13] DAYS_BEFORE_MONTH = [0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334]
+
+
+cdef inline bint _is_space(char c) nogil:
+    return c == c' ' or c == c'\t' or c == c'\r' or c == c'\n'
+
+
+cdef inline int _digits(const char* s, int count) except -1:
+    cdef int value = 0
+    cdef int i
+    for i in range(count):
+        if not (c'0' <= s[i] <= c'9'):
+            raise ValueError("invalid timestamp")
+        value = value * 10 + (s[i] - c'0')
+    return value
+
+
+cdef inline long _ordinal(int year, int month, int day) nogil:
+    """Proleptic Gregorian ordinal, matching datetime.toordinal()."""
+    cdef long y = year - 1
+    cdef bint leap = year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+    return (
+        y * 365 + y // 4 - y // 100 + y // 400
+        + DAYS_BEFORE_MONTH[month] + (month > 2 and leap) + day
+    )
+
+
+cpdef tuple parse_fields(bytes line):
+    """Parse a raw log line into LogEntry field order.
+
+    Returns (timestamp, customer_id, request_path, status_code, duration,
+    day_ord) and raises ValueError for malformed lines.
+    """
+    cdef const char* s = line
+    cdef Py_ssize_t n = len(line)
+    cdef Py_ssize_t i = 0, start, digits
+    cdef const char* p
+    cdef char* end
+    cdef int year, month, day, hour, minute, second
+    cdef long customer_id, status_code
+    cdef double duration
+
+    while i < n and _is_space(s[i]):
+        i += 1
+
+    # Fixed-width "YYYY-MM-DD HH:MM:SS"
+    p = s + i
+    if (
+        n - i < 19 or p[4] != c'-' or p[7] != c'-' or p[10] != c' '
+        or p[13] != c':' or p[16] != c':'
+    ):
+        raise ValueError("invalid timestamp")
+    year = _digits(p, 4)
+    month = _digits(p + 5, 2)
+    day = _digits(p + 8, 2)
+    hour = _digits(p + 11, 2)
+    minute = _digits(p + 14, 2)
+    second = _digits(p + 17, 2)
+    timestamp = datetime_new(year, month, day, hour, minute, second, 0, UTC)
+    i += 19
+    if i < n and not _is_space(s[i]):
+        raise ValueError("invalid timestamp")
+
+    while i < n and _is_space(s[i]):
+        i += 1
+    start = i
+    while i < n and not _is_space(s[i]):
+        i += 1
+    if i == start:
+        raise ValueError("missing customer id")
+    # Integer key after the last underscore, as in models.customer_id_to_int
+    digits = i
+    while digits > start and s[digits - 1] != c'_':
+        digits -= 1
+    customer_id = strtol(s + digits, &end, 10)
+    if end == s + digits or end != s + i:
+        raise ValueError("invalid customer id")
+    if not CUSTOMER_ID_MIN <= customer_id <= CUSTOMER_ID_MAX:
+        raise ValueError("customer id out of range")
+
+    while i < n and _is_space(s[i]):
+        i += 1
+    start = i
+    while i < n and not _is_space(s[i]):
+        i += 1
+    if i == start:
+        raise ValueError("missing request path")
+    request_path = s[start:i].decode("utf-8")
+
+    while i < n and _is_space(s[i]):
+        i += 1
+    status_code = strtol(s + i, &end, 10)
+    if end == s + i or (end < s + n and not _is_space(end[0])):
+        raise ValueError("invalid status code")
+    i = end - s
+
+    while i < n and _is_space(s[i]):
+        i += 1
+    duration = strtod(s + i, &end)
+    if end == s + i or (end < s + n and not _is_space(end[0])):
+        raise ValueError("invalid duration")
+
+    return (
+        timestamp,
+        customer_id,
+        request_path,
+        status_code,
+        duration,
+        _ordinal(year, month, day),
+    )
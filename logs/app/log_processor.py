@@ -1,229 +1,420 @@
+import mmap
 import os
-from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
-from typing import List, Optional, Tuple
-from statistics import mean, median
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Tuple
 
 import numpy as np
+from crick import TDigest
 import bytewax.operators as op
 from bytewax.dataflow import Dataflow
 from bytewax.operators.windowing import TumblingWindower, EventClock
-from bytewax.connectors.files import FileSource
+from bytewax.inputs import FixedPartitionedSource, StatefulSourcePartition
 from bytewax.operators import windowing as win
+from psycopg2.extras import execute_values
+from sqlalchemy import select, text
 from sqlalchemy.orm import Session
-from bytewax.testing import run_main
+from bytewax.run import cli_main
 
-from models import CustomerDailyStats, engine
+from models import CustomerDailyStats, customer_id_to_int, engine, serialize_digest
 
+UTC = timezone.utc
+SECONDS_IN_DAY = 24 * 60 * 60
+DB_BATCH_SIZE = 1000
+DB_BATCH_TIMEOUT = timedelta(seconds=5)
+WORKERS = os.cpu_count() or 1
+NEWLINE = ord("\n")
 
-@dataclass
+
+@dataclass(slots=True)
 class LogEntry:
     """Represents a single log entry."""
 
     timestamp: datetime
-    customer_id: str
+    customer_id: int
     request_path: str
     status_code: int
     duration: float
+    day_ord: int  # proleptic Gregorian ordinal of the timestamp's date
+
+
+class StatsRow(NamedTuple):
+    """A customer's aggregated statistics for one day, ready to be saved."""
+
+    customer_id: int
+    date: date
+    successful_requests: int
+    failed_requests: int
+    uptime_percentage: float
+    avg_latency: float
+    median_latency: float
+    p99_latency: float
+    latency_digest: bytes
+
 
+@dataclass(slots=True)
+class RunningStats:
+    """Running aggregate of a customer's entries within one daily window.
 
-@dataclass
-class DailyStats:
-    """Represents aggregated daily statistics for a customer."""
+    Latencies are summarised in a t-digest and downtime is tracked with a
+    small state machine, so the folded state stays small. The state machine
+    assumes entries arrive in timestamp order, which the window only
+    guarantees by buffering them first (see `build_dataflow`).
+    """
 
-    customer_id: str
-    date: datetime
+    customer_id: int = 0
+    day_ord: int = 0
     successful_requests: int = 0
     failed_requests: int = 0
-    uptime_percentage: float = 100.0
-    latencies: List[float] = None
-
-    def __post_init__(self):
-        if self.latencies is None:
-            self.latencies = []
+    latency_sum: float = 0.0
+    latencies: TDigest = field(default_factory=TDigest)
+    down_start: Optional[int] = None
+    downtime: int = 0
+    first_ts: Optional[int] = None
+    last_ts: Optional[int] = None
 
     @property
-    def avg_latency(self) -> float:
-        return mean(self.latencies) if self.latencies else 0.0
+    def count(self) -> int:
+        return self.successful_requests + self.failed_requests
 
     @property
-    def median_latency(self) -> float:
-        return median(self.latencies) if self.latencies else 0.0
+    def uptime_percentage(self) -> float:
+        downtime = self.downtime
+        if self.down_start is not None:
+            downtime += self.last_ts - self.down_start
+        uptime_percentage = ((SECONDS_IN_DAY - downtime) / SECONDS_IN_DAY) * 100
+        return max(0.0, min(100.0, uptime_percentage))
+
+
+def update_running_stats(stats: RunningStats, entry: LogEntry) -> RunningStats:
+    """Fold a single log entry into the window's running statistics."""
+    ts = int(entry.timestamp.timestamp())
+    status_code = entry.status_code
+    duration = entry.duration
+    down_start = stats.down_start
+
+    if stats.first_ts is None:
+        stats.customer_id = entry.customer_id
+        stats.day_ord = entry.day_ord
+        stats.first_ts = ts
+    if 200 <= status_code < 300:
+        stats.successful_requests += 1
+    else:
+        stats.failed_requests += 1
+    stats.latency_sum += duration
+    stats.latencies.add(duration)
+
+    is_error = 500 <= status_code < 600
+    if is_error and down_start is None:
+        stats.down_start = ts
+    elif not is_error and down_start is not None:
+        stats.downtime += ts - down_start
+        stats.down_start = None
+    stats.last_ts = ts
+
+    return stats
+
+
+def merge_running_stats(stats: RunningStats, later: RunningStats) -> RunningStats:
+    """Merge the running statistics of two consecutive windows."""
+    if later.count == 0:
+        return stats
+    if stats.count == 0:
+        return later
+
+    stats.successful_requests += later.successful_requests
+    stats.failed_requests += later.failed_requests
+    stats.latency_sum += later.latency_sum
+    stats.latencies.merge(later.latencies)
+    if stats.down_start is not None:
+        # An outage still open at the end of `stats` lasts until `later` starts.
+        stats.downtime += later.first_ts - stats.down_start
+    stats.downtime += later.downtime
+    stats.down_start = later.down_start
+    stats.last_ts = later.last_ts
+    return stats
+
+
+class _MmapPartition(StatefulSourcePartition[bytes, int]):
+    """Yields the lines starting within `[start, end)` bytes of a mapped file."""
+
+    def __init__(
+        self,
+        path: str,
+        start: int,
+        end: int,
+        chunk_size: int,
+        resume_state: Optional[int],
+    ):
+        self._size = os.path.getsize(path)
+        self._mm = None
+        self._end = end
+        self._chunk_size = chunk_size
+        self._offset = end
+        if start >= end:
+            return
+
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if resume_state is not None:
+            self._offset = resume_state
+        elif start > 0:
+            # The line straddling `start` belongs to the previous range
+            newline = self._mm.find(b"\n", start - 1)
+            self._offset = newline + 1 if newline >= 0 else self._size
+        else:
+            self._offset = 0
 
-    @property
-    def p99_latency(self) -> float:
-        return np.percentile(self.latencies, 99) if self.latencies else 0.0
-
-    def to_db_model(self) -> CustomerDailyStats:
-        """Convert to database model"""
-        return CustomerDailyStats(
-            customer_id=self.customer_id,
-            date=self.date.date().replace(tzinfo=timezone.utc),
-            successful_requests=self.successful_requests,
-            failed_requests=self.failed_requests,
-            uptime_percentage=self.uptime_percentage,
-            avg_latency=self.avg_latency,
-            median_latency=self.median_latency,
-            p99_latency=self.p99_latency,
+    def next_batch(self) -> List[bytes]:
+        if self._offset >= self._end:
+            raise StopIteration()
+
+        stop = min(self._offset + self._chunk_size, self._size)
+        chunk = np.frombuffer(
+            self._mm, dtype=np.uint8, count=stop - self._offset, offset=self._offset
+        )
+        line_ends = (np.flatnonzero(chunk == NEWLINE) + self._offset).tolist()
+        del chunk  # release the buffer export so the map can be closed later
+
+        if stop == self._size and (not line_ends or line_ends[-1] != stop - 1):
+            line_ends.append(self._size)  # last line has no trailing newline
+        elif not line_ends:
+            # A single line longer than the chunk
+            newline = self._mm.find(b"\n", stop)
+            line_ends.append(newline if newline >= 0 else self._size)
+
+        lines = []
+        start = self._offset
+        for line_end in line_ends:
+            if start >= self._end:
+                break
+            lines.append(self._mm[start:line_end])
+            start = line_end + 1
+        self._offset = start
+        return lines
+
+    def snapshot(self) -> int:
+        return self._offset
+
+    def close(self) -> None:
+        if self._mm is not None:
+            self._mm.close()
+
+
+class MmapSource(FixedPartitionedSource[bytes, int]):
+    """Read a memory-mapped file as several line-aligned byte ranges.
+
+    Each range is its own partition, so lines are parsed in parallel across
+    workers. Newlines are located with NumPy over the mapped pages, and lines
+    are emitted as raw bytes, leaving decoding to the parser.
+    """
+
+    def __init__(self, path: str, partitions: int = WORKERS, chunk_size: int = 1 << 20):
+        self._path = path
+        self._partitions = partitions
+        self._chunk_size = chunk_size
+
+    def list_parts(self) -> List[str]:
+        return [str(i) for i in range(self._partitions)]
+
+    def build_part(
+        self, step_id: str, for_part: str, resume_state: Optional[int]
+    ) -> _MmapPartition:
+        size = os.path.getsize(self._path)
+        index = int(for_part)
+        return _MmapPartition(
+            self._path,
+            start=size * index // self._partitions,
+            end=size * (index + 1) // self._partitions,
+            chunk_size=self._chunk_size,
+            resume_state=resume_state,
         )
 
 
-def build_dataflow(input_path: str) -> Tuple[Dataflow, object]:
+def build_dataflow(
+    input_path: str, partitions: int = WORKERS
+) -> Tuple[Dataflow, object]:
     """Build the dataflow for processing logs."""
     flow = Dataflow("log_processor")
 
-    source = FileSource(input_path)
+    source = MmapSource(input_path, partitions)
     stream = op.input("input", flow, source)
 
     parsed = op.map("parse", stream, parse_log_line)
     valid_entries = op.filter("valid", parsed, lambda x: x is not None)
 
-    def customer_date_event(entry: LogEntry) -> Tuple[str, LogEntry]:
-        return f"{entry.customer_id}_{entry.timestamp.date()}", entry
-
-    keyed = op.map("customer_date_event", valid_entries, customer_date_event)
+    # Bytewax state keys must be strings. The event clock tracks its
+    # watermark per key, so the key includes the day: keyed by customer
+    # alone, entries more than a day older than the customer's newest one
+    # would be dropped as late.
+    keyed = op.key_on(
+        "customer_day", valid_entries, lambda e: f"{e.customer_id}_{e.day_ord}"
+    )
 
     event_time_config = EventClock(
         ts_getter=lambda e: e.timestamp,
         wait_for_system_duration=timedelta(days=1),
-        now_getter=lambda: datetime.now().replace(tzinfo=timezone.utc),
+        now_getter=lambda: datetime.now(UTC),
     )
     clock_config = TumblingWindower(
         length=timedelta(days=1),
-        align_to=datetime(2024, 11, 7).replace(tzinfo=timezone.utc),
+        align_to=datetime(2024, 11, 7, tzinfo=UTC),
     )
-    window = win.collect_window(
-        "windowed_data", keyed, clock=event_time_config, windower=clock_config
+    window = win.fold_window(
+        "windowed_data",
+        keyed,
+        clock=event_time_config,
+        windower=clock_config,
+        builder=RunningStats,
+        folder=update_running_stats,
+        merger=merge_running_stats,
+        # Entries must be folded in timestamp order for the downtime state
+        # machine. bytewax holds every entry until the watermark passes it,
+        # so up to `wait_for_system_duration` (one day) of each customer's
+        # entries stays buffered on top of the running stats.
+        ordered=True,
     )
 
-    def format_stats(key_stats):
-        key, stats = key_stats
-        offset, entries = stats
-
-        daily_stats = DailyStats(
-            customer_id=entries[0].customer_id if entries else "",
-            date=entries[0].timestamp if entries else datetime.now(timezone.utc),
+    def format_stats(key_stats) -> Optional[StatsRow]:
+        _, (offset, stats) = key_stats
+        count = stats.count
+        if not count:
+            return None
+
+        latencies = stats.latencies
+        return StatsRow(
+            customer_id=stats.customer_id,
+            date=date.fromordinal(stats.day_ord),
+            successful_requests=stats.successful_requests,
+            failed_requests=stats.failed_requests,
+            uptime_percentage=stats.uptime_percentage,
+            avg_latency=stats.latency_sum / count,
+            median_latency=float(latencies.quantile(0.5)),
+            p99_latency=float(latencies.quantile(0.99)),
+            latency_digest=serialize_digest(latencies),
         )
 
-        daily_stats.uptime_percentage = calculate_uptime_percentage(entries)
-
-        for entry in entries:
-            if 200 <= entry.status_code < 300:
-                daily_stats.successful_requests += 1
-            else:
-                daily_stats.failed_requests += 1
-            daily_stats.latencies.append(entry.duration)
-
-        return {
-            "customer_id": daily_stats.customer_id,
-            "date": daily_stats.date.strftime("%Y-%m-%d"),
-            "successful_requests": daily_stats.successful_requests,
-            "failed_requests": daily_stats.failed_requests,
-            "uptime_percentage": daily_stats.uptime_percentage,
-            "avg_latency": daily_stats.avg_latency,
-            "median_latency": daily_stats.median_latency,
-            "p99_latency": daily_stats.p99_latency,
-        }
-
-    formatted = op.map("format_stats", window.down, format_stats)
+    formatted = op.filter_map("format_stats", window.down, format_stats)
     return flow, formatted
 
 
-def parse_log_line(line: str) -> Optional[LogEntry]:
-    """Parse a single log line into a LogEntry."""
+@lru_cache(maxsize=65536)
+def parse_timestamp(day: bytes, time: bytes) -> datetime:
+    """Parse a fixed-format `YYYY-MM-DD` / `HH:MM:SS` pair into a UTC datetime."""
+    if len(day) != 10 or len(time) != 8:
+        raise ValueError(f"invalid timestamp: {day} {time}")
+    return datetime(
+        int(day[0:4]),
+        int(day[5:7]),
+        int(day[8:10]),
+        int(time[0:2]),
+        int(time[3:5]),
+        int(time[6:8]),
+        tzinfo=UTC,
+    )
+
+
+def _parse_fields_py(line: bytes) -> tuple:
+    """Split a raw log line into LogEntry fields, in declaration order."""
+    parts = line.split()
+    timestamp = parse_timestamp(parts[0], parts[1])
+    return (
+        timestamp,
+        customer_id_to_int(parts[2].decode()),
+        parts[3].decode(),
+        int(parts[4]),
+        float(parts[5]),
+        timestamp.toordinal(),
+    )
+
+
+try:
+    # C implementation, built with `python setup.py build_ext --inplace`
+    from log_parser import parse_fields
+except ImportError:
+    parse_fields = _parse_fields_py
+
+
+def parse_log_line(line: bytes) -> Optional[LogEntry]:
+    """Parse a single raw log line into a LogEntry."""
     try:
-        parts = line.strip().split()
-        timestamp = datetime.strptime(
-            f"{parts[0]} {parts[1]}", "%Y-%m-%d %H:%M:%S"
-        ).replace(tzinfo=timezone.utc)
-        return LogEntry(
-            timestamp=timestamp,
-            customer_id=parts[2],
-            request_path=parts[3],
-            status_code=int(parts[4]),
-            duration=float(parts[5]),
-        )
+        return LogEntry(*parse_fields(line))
     except (IndexError, ValueError) as e:
         print(f"Error parsing line: {line}. Error: {e}")
         return None
 
 
-def save_to_database(stats_dict: dict):
-    """Save the statistics to the database"""
-    with Session(engine) as session:
-        db_stats = CustomerDailyStats(
-            customer_id=stats_dict["customer_id"],
-            date=datetime.strptime(stats_dict["date"], "%Y-%m-%d").date(),
-            successful_requests=stats_dict["successful_requests"],
-            failed_requests=stats_dict["failed_requests"],
-            uptime_percentage=stats_dict["uptime_percentage"],
-            avg_latency=stats_dict["avg_latency"],
-            median_latency=stats_dict["median_latency"],
-            p99_latency=stats_dict["p99_latency"],
-        )
+BULK_UPSERT_SQL = """
+    INSERT INTO {table} ({columns}) VALUES %s
+    ON CONFLICT (customer_id, date) DO UPDATE SET {updates}
+""".format(
+    table=CustomerDailyStats.__tablename__,
+    columns=", ".join(StatsRow._fields),
+    updates=", ".join(
+        f"{key} = EXCLUDED.{key}"
+        for key in StatsRow._fields
+        if key not in ["customer_id", "date"]
+    ),
+)
 
-        existing = (
-            session.query(CustomerDailyStats)
-            .filter(
-                CustomerDailyStats.customer_id == db_stats.customer_id,
-                CustomerDailyStats.date == db_stats.date,
-            )
-            .first()
-        )
 
-        if existing:
-            for key, value in stats_dict.items():
-                if key not in ["customer_id", "date"]:
-                    setattr(existing, key, value)
-            session.add(existing)
-        else:
-            session.add(db_stats)
+def bulk_save(stats_rows: List[StatsRow]):
+    """Upsert many statistics rows with psycopg2's execute_values.
 
-        session.commit()
+    Bypasses the SQLAlchemy statement layer so large backfills send
+    thousands of rows per protocol message.
+    """
+    if not stats_rows:
+        return
+
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            execute_values(cursor, BULK_UPSERT_SQL, stats_rows, page_size=DB_BATCH_SIZE)
+        connection.commit()
+    finally:
+        connection.close()
 
 
 def save_to_db_step(stream):
     """Add database save step to the dataflow"""
-    return op.map("save_to_db", stream, save_to_database)
-
-
-def calculate_uptime_percentage(entries: List[LogEntry]) -> float:
-    """Calculate uptime percentage for a given day's entries."""
-    if not entries:
-        return 100.0
-
-    total_duration = 24 * 60 * 60  # Total seconds in a day
-    downtime = 0
-    down_start = None
-
-    for entry in entries:
-        is_error = 500 <= entry.status_code < 600
-        if is_error and down_start is None:
-            down_start = entry.timestamp
-        elif not is_error and down_start is not None:
-            downtime += (entry.timestamp - down_start).total_seconds()
-            down_start = None
+    keyed = op.key_on("db_batch_key", stream, lambda _: "stats")
+    batches = op.collect(
+        "db_batch", keyed, timeout=DB_BATCH_TIMEOUT, max_size=DB_BATCH_SIZE
+    )
+    return op.map("save_to_db", batches, lambda batch: bulk_save(batch[1]))
 
-    if down_start is not None:
-        downtime += (entries[-1].timestamp - down_start).total_seconds()
 
-    uptime_percentage = ((total_duration - downtime) / total_duration) * 100
-    return max(0.0, min(100.0, uptime_percentage))
+def refresh_weekly_stats():
+    """Refresh the weekly rollup view from the daily statistics"""
+    with engine.begin() as connection:
+        connection.execute(
+            text("REFRESH MATERIALIZED VIEW CONCURRENTLY customer_weekly_stats")
+        )
 
 
 def verify_data():
     """Verify data in database"""
     print("Verifying data in database...")
     with Session(engine) as session:
-        count = session.query(CustomerDailyStats).count()
-        print(f"Found {count} records in database")
-
-        if count > 0:
-            records = session.query(CustomerDailyStats).all()
-            for record in records:
-                print(
-                    f"Customer: {record.customer_id}, Date: {record.date}, Uptime: {record.uptime_percentage}%"
-                )
+        # Planner estimate from pg_class: a catalog lookup instead of COUNT(*).
+        # ANALYZE first so the estimate reflects the rows just written.
+        session.execute(text("ANALYZE customerdailystats"))
+        count = session.execute(
+            text(
+                "SELECT reltuples::bigint FROM pg_class"
+                " WHERE relname = 'customerdailystats'"
+            )
+        ).scalar()
+        print(f"Found approximately {count} records in database")
+
+        # Print a small sample rather than every row
+        records = session.scalars(select(CustomerDailyStats).limit(10))
+        for record in records:
+            print(
+                f"Customer: {record.customer_id}, Date: {record.date}, Uptime: {record.uptime_percentage}%"
+            )
 
 
 def process_logs(log_file: str):
@@ -239,8 +430,8 @@ def process_logs(log_file: str):
     # required by bytewax to have at least one output step
     _ = op.inspect("inspect", save_stream)
 
-    # Run the dataflow
-    run_main(flow)
+    # Run the dataflow, parsing the file on one worker per CPU
+    cli_main(flow, workers_per_process=WORKERS)
 
     print("Log processing completed")
 
@@ -251,6 +442,7 @@ def main():
     log_file = "api_requests.log"
     if os.path.exists(log_file):
         process_logs(log_file)
+        refresh_weekly_stats()
         verify_data()
     else:
         print(f"Log file not found: {log_file}")
@@ -1,23 +1,99 @@
 from datetime import date
-from sqlalchemy import Column, Integer, String, Date, Float, create_engine
+from typing import Optional
+
+import numpy as np
+from crick import TDigest
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Integer,
+    Date,
+    Float,
+    Index,
+    LargeBinary,
+    MetaData,
+    Table,
+    UniqueConstraint,
+    create_engine,
+)
 from sqlalchemy.ext.declarative import declarative_base
 import os
 
 Base = declarative_base()
 
+# Materialized views are created by migrations, never by create_all
+views = MetaData()
+
 
 class CustomerDailyStats(Base):
     __tablename__ = "customerdailystats"
+    __table_args__ = (
+        UniqueConstraint(
+            "customer_id", "date", name="uq_customerdailystats_customer_id_date"
+        ),
+        # Rows arrive in date order, so a BRIN index stays tiny
+        Index("ix_customerdailystats_date_brin", "date", postgresql_using="brin"),
+    )
 
     id = Column(Integer, primary_key=True)
-    customer_id = Column(String, index=True)
-    date = Column(Date, index=True)
+    customer_id = Column(Integer, nullable=False)
+    date = Column(Date, nullable=False)
     successful_requests = Column(Integer)
     failed_requests = Column(Integer)
     uptime_percentage = Column(Float)
     avg_latency = Column(Float)
     median_latency = Column(Float)
     p99_latency = Column(Float)
+    latency_digest = Column(LargeBinary)
+
+
+customer_weekly_stats = Table(
+    "customer_weekly_stats",
+    views,
+    Column("customer_id", Integer),
+    Column("week", Date),
+    Column("successful_requests", BigInteger),
+    Column("failed_requests", BigInteger),
+    Column("uptime_percentage", Float),
+    Column("avg_latency", Float),
+    Column("latency_digest", LargeBinary),
+)
+
+# Bounds of the Postgres `integer` customer_id column
+CUSTOMER_ID_MIN = -(2**31)
+CUSTOMER_ID_MAX = 2**31 - 1
+DIGEST_DTYPE = np.dtype([("mean", "<f8"), ("weight", "<f8")])
+
+
+def serialize_digest(digest: TDigest) -> bytes:
+    """Serialize a t-digest as packed (mean, weight) float64 centroid pairs.
+
+    Concatenated serialized digests are themselves a valid serialized digest,
+    which lets Postgres merge them with a plain bytea string_agg.
+    """
+    return digest.centroids().astype(DIGEST_DTYPE).tobytes()
+
+
+def deserialize_digest(data: Optional[bytes]) -> TDigest:
+    """Rebuild a t-digest from (possibly concatenated) serialized centroids"""
+    digest = TDigest()
+    if data:
+        centroids = np.frombuffer(data, dtype=DIGEST_DTYPE)
+        digest.update(centroids["mean"], centroids["weight"])
+    return digest
+
+
+def customer_id_to_int(customer_id: str) -> int:
+    """Convert an external customer id such as `cust_42` to its integer key"""
+    key = int(customer_id.rpartition("_")[2])
+    if not CUSTOMER_ID_MIN <= key <= CUSTOMER_ID_MAX:
+        raise ValueError(f"customer id out of range: {customer_id}")
+    return key
+
+
+def customer_id_to_str(customer_id: int) -> str:
+    """Convert an integer customer key back to its external `cust_42` form"""
+    return f"cust_{customer_id}"
 
 
 # Database connection
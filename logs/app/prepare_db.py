@@ -12,6 +12,7 @@ from bytewax.dataflow import Dataflow
 from bytewax.operators.windowing import TumblingWindower, EventClock
 from bytewax.connectors.files import FileSource
 from bytewax.operators import windowing as win
+from sqlalchemy import select, text
 from sqlalchemy.orm import Session
 from bytewax.testing import run_main
 import alembic.config
@@ -46,15 +47,23 @@ def verify_data():
     """Verify data in database"""
     print("Verifying data in database...")
     with Session(engine) as session:
-        count = session.query(CustomerDailyStats).count()
-        print(f"Found {count} records in database")
-
-        if count > 0:
-            records = session.query(CustomerDailyStats).all()
-            for record in records:
-                print(
-                    f"Customer: {record.customer_id}, Date: {record.date}, Uptime: {record.uptime_percentage}%"
-                )
+        # Planner estimate from pg_class: a catalog lookup instead of COUNT(*).
+        # ANALYZE first so the estimate reflects the rows just written.
+        session.execute(text("ANALYZE customerdailystats"))
+        count = session.execute(
+            text(
+                "SELECT reltuples::bigint FROM pg_class"
+                " WHERE relname = 'customerdailystats'"
+            )
+        ).scalar()
+        print(f"Found approximately {count} records in database")
+
+        # Print a small sample rather than every row
+        records = session.scalars(select(CustomerDailyStats).limit(10))
+        for record in records:
+            print(
+                f"Customer: {record.customer_id}, Date: {record.date}, Uptime: {record.uptime_percentage}%"
+            )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+import unittest
+from datetime import date, timedelta
+from unittest.mock import patch
+
+import numpy as np
+from crick import TDigest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from app.api import app, weekly_row_to_dict
+from app.models import (
+    Base,
+    CustomerDailyStats,
+    customer_weekly_stats,
+    serialize_digest,
+    views,
+)
+
+
+def make_digest(values):
+    digest = TDigest()
+    digest.update(np.array(values, dtype=np.float64))
+    return serialize_digest(digest)
+
+
+class TestApi(unittest.TestCase):
+    def setUp(self):
+        """Serve the API from an in-memory SQLite database"""
+        self.engine = create_engine(
+            "sqlite://",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        Base.metadata.create_all(self.engine)
+        views.create_all(self.engine)
+
+        self.patcher = patch("app.api.engine", self.engine)
+        self.patcher.start()
+        self.client = TestClient(app)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.engine.dispose()
+
+    def insert_daily(self, customer_id, days):
+        with self.engine.begin() as connection:
+            connection.execute(
+                CustomerDailyStats.__table__.insert(),
+                [
+                    dict(
+                        customer_id=customer_id,
+                        date=date(2024, 10, 1) + timedelta(days=day),
+                        successful_requests=day,
+                        failed_requests=0,
+                        uptime_percentage=100.0,
+                        avg_latency=1.0,
+                        median_latency=1.0,
+                        p99_latency=1.0,
+                        latency_digest=make_digest([1.0]),
+                    )
+                    for day in range(days)
+                ],
+            )
+
+    def insert_weekly(self, customer_id, weeks):
+        with self.engine.begin() as connection:
+            connection.execute(
+                customer_weekly_stats.insert(),
+                [
+                    dict(
+                        customer_id=customer_id,
+                        week=week,
+                        successful_requests=2,
+                        failed_requests=1,
+                        uptime_percentage=100.0,
+                        avg_latency=2.0,
+                        latency_digest=make_digest([1.0, 2.0]) + make_digest([3.0]),
+                    )
+                    for week in weeks
+                ],
+            )
+
+    def test_daily_stats(self):
+        """Test daily rows are returned with the external customer id"""
+        self.insert_daily(1, 3)
+
+        response = self.client.get("/customers/cust_1/stats?from=2024-10-02")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], "application/json")
+        stats = response.json()
+        self.assertEqual([s["date"] for s in stats], ["2024-10-02", "2024-10-03"])
+        self.assertEqual(stats[0]["customer_id"], "cust_1")
+        self.assertNotIn("latency_digest", stats[0])
+
+    def test_stats_are_spliced_across_batches(self):
+        """Test several fetch batches are streamed as one JSON array"""
+        self.insert_daily(1, 5)
+
+        with patch("app.api.STREAM_BATCH_SIZE", 2):
+            response = self.client.get("/customers/cust_1/stats")
+
+        self.assertEqual(response.status_code, 200)
+        stats = response.json()
+        self.assertEqual([s["successful_requests"] for s in stats], [0, 1, 2, 3, 4])
+
+    def test_no_stats_found(self):
+        """Test unknown and malformed customer ids return 404"""
+        self.insert_daily(1, 1)
+
+        for url in (
+            "/customers/cust_2/stats",
+            "/customers/cust_1/stats?from=2024-11-01",
+            "/customers/guest/stats",
+            "/customers/cust_1/stats?granularity=week",
+        ):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 404, url)
+            self.assertEqual(response.json(), {"detail": "No stats found for customer"})
+
+    def test_weekly_stats_snap_from_to_week_start(self):
+        """Test `from` includes the whole week it falls in"""
+        self.insert_weekly(1, [date(2024, 10, 14), date(2024, 10, 21)])
+
+        # 2024-10-23 is a Wednesday, so its week starts on 2024-10-21
+        response = self.client.get(
+            "/customers/cust_1/stats?granularity=week&from=2024-10-23"
+        )
+
+        self.assertEqual(response.status_code, 200)
+        (stats,) = response.json()
+        self.assertEqual(stats["week"], "2024-10-21")
+        self.assertEqual(stats["customer_id"], "cust_1")
+        self.assertEqual(stats["median_latency"], 2.0)
+        self.assertEqual(stats["p99_latency"], 3.0)
+
+    def test_weekly_row_to_dict(self):
+        """Test quantiles are estimated from the concatenated daily digests"""
+        row = dict(
+            customer_id=1,
+            week=date(2024, 10, 21),
+            latency_digest=make_digest([1.0, 2.0]) + make_digest([3.0, 4.0]),
+        )
+
+        stats = weekly_row_to_dict(row)
+
+        self.assertNotIn("latency_digest", stats)
+        self.assertEqual(stats["customer_id"], "cust_1")
+        self.assertAlmostEqual(stats["median_latency"], 2.5)
+        self.assertAlmostEqual(stats["p99_latency"], 4.0)
+
+        stats = weekly_row_to_dict(dict(row, latency_digest=None))
+        self.assertIsNone(stats["median_latency"])
+        self.assertIsNone(stats["p99_latency"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,18 +1,26 @@
 import os
+import random
 import unittest
-from datetime import datetime
-from unittest.mock import patch, MagicMock
+from datetime import date, datetime, timedelta, timezone
+from unittest.mock import patch
 import tempfile
 import numpy as np
-from bytewax.testing import TestingSink, run_main
+from bytewax.testing import TestingSink, cluster_main, run_main
 import bytewax.operators as op
 
+from models import deserialize_digest
 from log_processor import (
     LogEntry,
-    DailyStats,
+    RunningStats,
+    MmapSource,
+    StatsRow,
     parse_log_line,
+    parse_fields,
+    _parse_fields_py,
+    update_running_stats,
     build_dataflow,
-    save_to_database,
+    save_to_db_step,
+    bulk_save,
 )
 
 # Sample log entries for testing
@@ -38,11 +46,9 @@ class TestLogProcessor(unittest.TestCase):
             self.temp_file.write(log + "\n")
         self.temp_file.close()
 
-        # Mock database session
-        self.patcher = patch("log_processor.Session")
-        self.mock_session = self.patcher.start()
-        self.session_instance = MagicMock()
-        self.mock_session.return_value.__enter__.return_value = self.session_instance
+        # Mock database engine
+        self.patcher = patch("log_processor.engine")
+        self.mock_engine = self.patcher.start()
 
     def tearDown(self):
         """Clean up test fixtures"""
@@ -70,127 +76,304 @@ class TestLogProcessor(unittest.TestCase):
 
         # Check customer 1 stats for Oct 26
         cust_1_stats_26 = next(
-            r
-            for r in results
-            if r["customer_id"] == "cust_1" and r["date"] == "2024-10-26"
+            r for r in results if r.customer_id == 1 and r.date == date(2024, 10, 26)
         )
-        self.assertEqual(cust_1_stats_26["successful_requests"], 2)
-        self.assertEqual(cust_1_stats_26["failed_requests"], 1)
-        self.assertEqual(cust_1_stats_26["uptime_percentage"], 100.0)
-        self.assertAlmostEqual(cust_1_stats_26["avg_latency"], 0.75)
-        self.assertAlmostEqual(cust_1_stats_26["median_latency"], 0.75)
-        self.assertAlmostEqual(cust_1_stats_26["p99_latency"], 0.995)
+        self.assertEqual(cust_1_stats_26.successful_requests, 2)
+        self.assertEqual(cust_1_stats_26.failed_requests, 1)
+        self.assertEqual(cust_1_stats_26.uptime_percentage, 100.0)
+        self.assertAlmostEqual(cust_1_stats_26.avg_latency, 0.75)
+        self.assertAlmostEqual(cust_1_stats_26.median_latency, 0.75)
+        # p99 comes from a t-digest, which is approximate for tiny samples
+        self.assertAlmostEqual(cust_1_stats_26.p99_latency, 0.995, delta=0.01)
 
         # Check customer 1 stats for Oct 27
         cust_1_stats_27 = next(
-            r
-            for r in results
-            if r["customer_id"] == "cust_1" and r["date"] == "2024-10-27"
+            r for r in results if r.customer_id == 1 and r.date == date(2024, 10, 27)
         )
-        self.assertEqual(cust_1_stats_27["successful_requests"], 1)
-        self.assertEqual(cust_1_stats_27["failed_requests"], 0)
-        self.assertEqual(cust_1_stats_27["uptime_percentage"], 100.0)
-        self.assertAlmostEqual(cust_1_stats_27["avg_latency"], 2.0)
-        self.assertAlmostEqual(cust_1_stats_27["median_latency"], 2.0)
-        self.assertAlmostEqual(cust_1_stats_27["p99_latency"], 2.0)
+        self.assertEqual(cust_1_stats_27.successful_requests, 1)
+        self.assertEqual(cust_1_stats_27.failed_requests, 0)
+        self.assertEqual(cust_1_stats_27.uptime_percentage, 100.0)
+        self.assertAlmostEqual(cust_1_stats_27.avg_latency, 2.0)
+        self.assertAlmostEqual(cust_1_stats_27.median_latency, 2.0)
+        self.assertAlmostEqual(cust_1_stats_27.p99_latency, 2.0)
 
         # Check customer 2 stats
-        cust_2_stats = next(r for r in results if r["customer_id"] == "cust_2")
-        self.assertEqual(cust_2_stats["date"], "2024-10-26")
-        self.assertEqual(cust_2_stats["successful_requests"], 2)
-        self.assertEqual(cust_2_stats["failed_requests"], 2)
+        cust_2_stats = next(r for r in results if r.customer_id == 2)
+        self.assertEqual(cust_2_stats.date, date(2024, 10, 26))
+        self.assertEqual(cust_2_stats.successful_requests, 2)
+        self.assertEqual(cust_2_stats.failed_requests, 2)
         seconds_in_day = 24 * 60 * 60
         downtime_seconds = 2  # 2 seconds of downtime based on log entries
         expected_uptime = ((seconds_in_day - downtime_seconds) / seconds_in_day) * 100
-        self.assertAlmostEqual(cust_2_stats["uptime_percentage"], expected_uptime)
-        self.assertAlmostEqual(cust_2_stats["avg_latency"], 1.0)
-        self.assertAlmostEqual(cust_2_stats["median_latency"], 1.0)
-        self.assertAlmostEqual(cust_2_stats["p99_latency"], 1.0)
+        self.assertAlmostEqual(cust_2_stats.uptime_percentage, expected_uptime)
+        self.assertAlmostEqual(cust_2_stats.avg_latency, 1.0)
+        self.assertAlmostEqual(cust_2_stats.median_latency, 1.0)
+        self.assertAlmostEqual(cust_2_stats.p99_latency, 1.0)
 
         # Check customer 20 stats
-        cust_20_stats = next(r for r in results if r["customer_id"] == "cust_20")
-        self.assertEqual(cust_20_stats["date"], "2024-10-28")
-        self.assertEqual(cust_20_stats["successful_requests"], 1)
-        self.assertEqual(cust_20_stats["failed_requests"], 0)
-        self.assertEqual(cust_20_stats["uptime_percentage"], 100.0)
-        self.assertAlmostEqual(cust_20_stats["avg_latency"], 3.0)
-        self.assertAlmostEqual(cust_20_stats["median_latency"], 3.0)
-        self.assertAlmostEqual(cust_20_stats["p99_latency"], 3.0)
+        cust_20_stats = next(r for r in results if r.customer_id == 20)
+        self.assertEqual(cust_20_stats.date, date(2024, 10, 28))
+        self.assertEqual(cust_20_stats.successful_requests, 1)
+        self.assertEqual(cust_20_stats.failed_requests, 0)
+        self.assertEqual(cust_20_stats.uptime_percentage, 100.0)
+        self.assertAlmostEqual(cust_20_stats.avg_latency, 3.0)
+        self.assertAlmostEqual(cust_20_stats.median_latency, 3.0)
+        self.assertAlmostEqual(cust_20_stats.p99_latency, 3.0)
+
+        # Serialized digests round-trip and merge by concatenation
+        digest = deserialize_digest(
+            cust_1_stats_26.latency_digest + cust_1_stats_27.latency_digest
+        )
+        self.assertEqual(digest.size(), 4)
+        self.assertAlmostEqual(digest.max(), 2.0)
 
         # Verify proper grouping
-        customer_ids = {r["customer_id"] for r in results}
-        self.assertEqual(customer_ids, {"cust_1", "cust_2", "cust_20"})
+        customer_ids = {r.customer_id for r in results}
+        self.assertEqual(customer_ids, {1, 2, 20})
 
-        date_groups = {(r["customer_id"], r["date"]) for r in results}
+        date_groups = {(r.customer_id, r.date) for r in results}
         expected_groups = {
-            ("cust_1", "2024-10-26"),
-            ("cust_1", "2024-10-27"),
-            ("cust_2", "2024-10-26"),
-            ("cust_20", "2024-10-28"),
+            (1, date(2024, 10, 26)),
+            (1, date(2024, 10, 27)),
+            (2, date(2024, 10, 26)),
+            (20, date(2024, 10, 28)),
         }
         self.assertEqual(date_groups, expected_groups)
 
+    def test_dataflow_merges_customer_id_spellings(self):
+        """Test spellings of one customer id share a single daily row"""
+        with open(self.temp_file.name, "w") as f:
+            for customer_id in ("cust_1", "cust_01", "1"):
+                f.write(f"2024-10-26 03:05:00 {customer_id} /api/v1/resource1 200 1.\n")
+
+        results = []
+        flow, stream = build_dataflow(self.temp_file.name)
+        op.output("output", stream, TestingSink(results))
+        run_main(flow)
+
+        (stats,) = results
+        self.assertEqual((stats.customer_id, stats.date), (1, date(2024, 10, 26)))
+        self.assertEqual(stats.successful_requests, 3)
+
+    def test_dataflow_shuffled_multi_day_log(self):
+        """Test no entries are dropped as late from a shuffled 30-day log"""
+        rng = random.Random(42)
+        start = datetime(2024, 10, 1, tzinfo=timezone.utc)
+        entries = [
+            (
+                start + timedelta(seconds=rng.randint(0, 30 * 24 * 60 * 60)),
+                rng.randint(1, 5),
+            )
+            for _ in range(2000)
+        ]
+        with open(self.temp_file.name, "w") as f:
+            for timestamp, customer_id in entries:
+                f.write(
+                    f"{timestamp:%Y-%m-%d %H:%M:%S} cust_{customer_id} "
+                    "/api/v1/resource1 200 1.\n"
+                )
+
+        results = []
+        flow, stream = build_dataflow(self.temp_file.name)
+        op.output("output", stream, TestingSink(results))
+        run_main(flow)
+
+        self.assertEqual(
+            sum(r.successful_requests + r.failed_requests for r in results),
+            len(entries),
+        )
+        self.assertEqual(
+            {(r.customer_id, r.date) for r in results},
+            {(customer_id, ts.date()) for ts, customer_id in entries},
+        )
+
+    def test_dataflow_skips_invalid_customer_ids(self):
+        """Test lines with a malformed customer id are dropped, not fatal"""
+        with open(self.temp_file.name, "a") as f:
+            f.write("2024-10-26 03:10:00 guest /api/v1/resource1 200 1.\n")
+
+        results = []
+        flow, stream = build_dataflow(self.temp_file.name)
+        op.output("output", stream, TestingSink(results))
+        run_main(flow)
+
+        self.assertEqual({r.customer_id for r in results}, {1, 2, 20})
+
+    def test_dataflow_out_of_order_entries(self):
+        """Test reversed input gives the same rows as in-order input"""
+
+        def run():
+            results = []
+            flow, stream = build_dataflow(self.temp_file.name)
+            op.output("output", stream, TestingSink(results))
+            run_main(flow)
+            return sorted(results)
+
+        in_order = run()
+        with open(self.temp_file.name, "w") as f:
+            for log in reversed(SAMPLE_LOGS):
+                f.write(log + "\n")
+
+        self.assertEqual(len(in_order), 4)
+        self.assertEqual(run(), in_order)
+
+    def test_dataflow_multiple_workers(self):
+        """Test several partitions and workers give the single-worker rows"""
+        start = datetime(2024, 10, 20, tzinfo=timezone.utc)
+        minutes = list(range(0, 10 * 24 * 60, 7))
+        random.Random(42).shuffle(minutes)
+        with open(self.temp_file.name, "w") as f:
+            for minute in minutes:
+                timestamp = start + timedelta(minutes=minute)
+                status_code = 500 if minute % 11 == 0 else 200
+                f.write(
+                    f"{timestamp:%Y-%m-%d %H:%M:%S} cust_{minute % 5} "
+                    f"/api/v1/resource1 {status_code} {minute % 13 / 10}\n"
+                )
+
+        def run(workers):
+            results = []
+            flow, stream = build_dataflow(self.temp_file.name, partitions=workers)
+            op.output("output", stream, TestingSink(results))
+            cluster_main(flow, [], 0, worker_count_per_proc=workers)
+            return sorted(results)
+
+        single_worker = run(1)
+        self.assertEqual(len(single_worker), 5 * 10)
+        self.assertEqual(
+            sum(r.successful_requests + r.failed_requests for r in single_worker),
+            len(minutes),
+        )
+        self.assertEqual(run(4), single_worker)
+
+    def test_mmap_source(self):
+        """Test every line is read by exactly one partition"""
+        expected = sorted(log.encode() for log in SAMPLE_LOGS)
+        for partitions in (1, 2, 3, 7, 50):
+            for chunk_size in (16, 1 << 20):
+                source = MmapSource(self.temp_file.name, partitions, chunk_size)
+                lines = []
+                for part in source.list_parts():
+                    partition = source.build_part("input", part, None)
+                    try:
+                        while True:
+                            lines.extend(partition.next_batch())
+                    except StopIteration:
+                        partition.close()
+                self.assertEqual(sorted(lines), expected)
+
     def test_parse_log_line(self):
         """Test log line parsing"""
         # Test valid log line
-        line = SAMPLE_LOGS[0]
+        line = SAMPLE_LOGS[0].encode()
         entry = parse_log_line(line)
 
         self.assertIsNotNone(entry)
         self.assertIsInstance(entry, LogEntry)
-        self.assertEqual(entry.customer_id, "cust_1")
+        self.assertEqual(
+            entry.timestamp, datetime(2024, 10, 26, 3, 5, tzinfo=timezone.utc)
+        )
+        self.assertEqual(entry.customer_id, 1)
         self.assertEqual(entry.status_code, 200)
         self.assertEqual(entry.duration, 0.5)
         self.assertEqual(entry.request_path, "/api/v1/resource2")
+        self.assertEqual(entry.day_ord, date(2024, 10, 26).toordinal())
 
         # Test invalid log line
-        invalid_line = "invalid log format"
+        invalid_line = b"invalid log format"
         self.assertIsNone(parse_log_line(invalid_line))
+        self.assertIsNone(
+            parse_log_line(b"2024-10-26 3:05:00 cust_1 /api/v1/resource2 200 0.5")
+        )
+        self.assertIsNone(
+            parse_log_line(b"2024-10-26 03:05:00 guest /api/v1/resource2 200 0.5")
+        )
+        self.assertIsNone(
+            parse_log_line(
+                b"2024-10-26 03:05:00 cust_99999999999 /api/v1/resource2 200 0.5"
+            )
+        )
 
-    def test_daily_stats_calculations(self):
-        """Test DailyStats calculations"""
-        stats = DailyStats("cust_1", datetime.now())
-
-        # Add successful request
-        stats.successful_requests += 1
-        stats.latencies.append(0.500)
-
-        # Add failed request
-        stats.failed_requests += 1
-        stats.latencies.append(1.500)
-        stats.latencies.append(1.600)  # Add one more latency for better p99 calculation
-
-        # Test calculations
-        self.assertEqual(stats.successful_requests, 1)
-        self.assertEqual(stats.failed_requests, 1)
-        self.assertEqual(stats.avg_latency, np.mean([0.5, 1.5, 1.6]))
-        self.assertEqual(stats.median_latency, np.median([0.5, 1.5, 1.6]))
-        self.assertGreaterEqual(stats.p99_latency, 1.5)
-
-    def test_save_to_database(self):
-        """Test database save operation with mocked session"""
-        stats_dict = {
-            "customer_id": "cust_1",
-            "date": "2024-10-26",
-            "successful_requests": 2,
-            "failed_requests": 1,
-            "uptime_percentage": 1,
-            "avg_latency": 0.75,
-            "median_latency": 0.75,
-            "p99_latency": 0.995,
-        }
+    @unittest.skipIf(
+        parse_fields is _parse_fields_py, "log_parser extension is not built"
+    )
+    def test_compiled_parser_matches_python(self):
+        """Test the Cython parser agrees with the pure-Python one"""
+        lines = [log.encode() for log in SAMPLE_LOGS] + [
+            b"2024-02-29 23:59:59\tcust_7 /api/v1/resource3 503 1e-3",
+            b"2024-10-26 03:05:00 cust_2147483647 /api/v1/resource2 200 0.5",
+        ]
+        for line in lines:
+            self.assertEqual(parse_fields(line), _parse_fields_py(line))
+
+        for line in (
+            b"invalid log format",
+            b"2024-10-26 3:05:00 cust_1 /api/v1/resource2 200 0.5",
+            b"2024-02-30 03:05:00 cust_1 /api/v1/resource2 200 0.5",
+            b"2024-10-26 03:05:00 cust_1 /api/v1/resource2 2x0 0.5",
+            b"2024-10-26 03:05:00 cust_1 /api/v1/resource2 200",
+            b"2024-10-26 03:05:00 guest /api/v1/resource2 200 0.5",
+            b"2024-10-26 03:05:00 cust_1x /api/v1/resource2 200 0.5",
+            b"2024-10-26 03:05:00 cust_ /api/v1/resource2 200 0.5",
+            b"2024-10-26 03:05:00 cust_99999999999 /api/v1/resource2 200 0.5",
+            b"2024-10-26 03:05:00 cust_2147483648 /api/v1/resource2 200 0.5",
+        ):
+            with self.assertRaises(ValueError):
+                parse_fields(line)
 
-        # Mock the query filter
-        self.session_instance.query.return_value.filter.return_value.first.return_value = (
-            None
+    def test_running_stats(self):
+        """Test folding entries into RunningStats"""
+        stats = RunningStats()
+        for line in SAMPLE_LOGS[4:8]:
+            stats = update_running_stats(stats, parse_log_line(line.encode()))
+
+        self.assertEqual(stats.successful_requests, 2)
+        self.assertEqual(stats.failed_requests, 2)
+        self.assertEqual(stats.downtime, 2)
+        self.assertIsNone(stats.down_start)
+
+        # Latency quantiles are approximate but close on larger samples
+        durations = np.random.default_rng(42).uniform(0.1, 2.0, 10_000)
+        stats = RunningStats()
+        for duration in durations:
+            stats.latencies.add(duration)
+        self.assertAlmostEqual(
+            stats.latencies.quantile(0.5), np.median(durations), delta=0.01
+        )
+        self.assertAlmostEqual(
+            stats.latencies.quantile(0.99), np.percentile(durations, 99), delta=0.01
         )
 
-        # Call the function
-        save_to_database(stats_dict)
+    @patch("log_processor.execute_values")
+    def test_bulk_save(self, mock_execute_values):
+        """Test bulk upsert through a raw psycopg2 connection"""
+        rows = [
+            StatsRow(1, date(2024, 10, 26), 2, 1, 100.0, 0.75, 0.75, 0.995, b""),
+            StatsRow(2, date(2024, 10, 26), 2, 2, 99.9, 1.0, 1.0, 1.0, b""),
+        ]
+
+        bulk_save(rows)
+
+        raw_connection = self.mock_engine.raw_connection.return_value
+        mock_execute_values.assert_called_once()
+        _, sql, values = mock_execute_values.call_args.args
+        self.assertIn("ON CONFLICT (customer_id, date) DO UPDATE", sql)
+        self.assertIn("p99_latency = EXCLUDED.p99_latency", sql)
+        self.assertEqual(values, rows)
+        raw_connection.commit.assert_called_once()
+        raw_connection.close.assert_called_once()
+
+    @patch("log_processor.execute_values")
+    def test_save_to_db_step_batches(self, mock_execute_values):
+        """Test all window outputs are saved in one batch"""
+        flow, stream = build_dataflow(self.temp_file.name)
+        op.inspect("inspect", save_to_db_step(stream), lambda *_: None)
+
+        run_main(flow)
 
-        # Verify the session was used correctly
-        self.session_instance.add.assert_called_once()
-        self.session_instance.commit.assert_called_once()
+        mock_execute_values.assert_called_once()
+        _, _, rows = mock_execute_values.call_args.args
+        self.assertEqual(len(rows), 4)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,14 @@
+"""Build the optional Cython log parser in place.
+
+    python setup.py build_ext --inplace
+"""
+
+from Cython.Build import cythonize
+from setuptools import Extension, setup
+
+setup(
+    ext_modules=cythonize(
+        [Extension("app.log_parser", ["app/log_parser.pyx"])],
+        compiler_directives={"language_level": 3},
+    ),
+)